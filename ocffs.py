@@ -7,24 +7,220 @@
 #
 # Usage:
 # ocffs.py syncfolder [otherfolder]
+# ocffs.py -c ocffs.conf
 #
 # 2018-08-19, jw 0.1 -- initial draft.
 # 2018-08-20, jw 0.2 -- xattr can be used. readdir() no longer sees placeholders.
 # 2018-08-21, jw 0.3 -- _oc_stat() done. all placeholders properly hidden.
 # 2018-08-22, jw 0.4 -- switching virtial physical via xattr user.owncloud.virtual works!
+# 2018-08-24, jw 0.5 -- daemon mode: one process serves many sync folders from a config file.
+#                       shared worker pool, client sockets and hydration budget. per-mount stats.
 #
 # TODO: read/write
 
 
 from __future__ import with_statement, print_function
 
-import os, re, sys
+import os, re, sys, json, signal, threading, subprocess, configparser
 import psutil, errno, sqlite3, time, socket
+from concurrent.futures import ThreadPoolExecutor
 
 # from fuse import FUSE, FuseOSError, Operations
 from fusepy import FUSE, FuseOSError, Operations, fuse_get_context
 
-_version_ = '0.4'
+_version_ = '0.5'
+
+
+def find_dbfile(root):
+    """ returns the path of the owncloud db file in the sync folder root, or None. """
+    dbfile = None
+    for name in os.listdir(root):
+        if re.match('\._sync_[a-f0-9]+\.db$', name): dbfile = root + '/' + name
+    return dbfile
+
+
+def find_owncloud_threads(dbfiles):
+    """ enumerate processes, filter those with same euid as one of the dbfiles.
+        then find those that also have a dbfile open.
+        We asume, we run as the user who owns the dbfiles.
+        (If not Process.open_file() may fail.)
+
+        A single process scan serves all dbfiles, so that a daemon with
+        many sync folders does not walk the process table once per folder.
+
+        Returns a dict of lists of triples: { dbfile: [ (pid, name, uid), ... ], ... }
+    """
+    db_paths = {}       # realpath -> (uid, [dbfile, ...]). Several names may lead to the same file.
+    for dbfile in dbfiles:
+        db_path = os.path.realpath(dbfile)
+        if db_path not in db_paths:
+            db_paths[db_path] = (os.stat(db_path).st_uid, [])
+        db_paths[db_path][1].append(dbfile)
+    db_uids = set(uid for (uid, names) in db_paths.values())
+    found = dict((dbfile, []) for dbfile in dbfiles)
+    for p in psutil.process_iter(attrs=['name']):
+        try:
+            euid = p.uids().effective
+            uid = p.uids().real
+        except:
+            continue    # process vanished while we looked.
+        if euid in db_uids or uid in db_uids:
+            try:
+                for f in p.open_files():
+                    if f.path in db_paths:
+                        (db_uid, names) = db_paths[f.path]
+                        if db_uid != euid and db_uid != uid:
+                            continue
+                        if p.pid == os.getpid():
+                            print("+ FIXME: saw myself on the database. Harmless, but should not happen.", file=sys.stderr)
+                        else:
+                            # print("+ seen: owncloud client pid=%s name=%s" % (p.pid, p.name()), file=sys.stderr)
+                            for dbfile in names:
+                                found[dbfile].append([p.pid, p.name(), db_uid])
+            except:
+                # open_files may fire PermissionError or psutil._exceptions.AccessDenied
+                # on e.g. "gpg-agent", which does not like to be examined.
+                pass
+    return found
+
+
+def parse_size(text):
+    """ '512', '64k', '100M', '2G' -> number of bytes. '0' or '' means unlimited. """
+    text = str(text).strip()
+    if not text:
+        return 0
+    m = re.match(r'^(\d+)\s*([kmgt]?)b?$', text, re.I)
+    if not m:
+        raise ValueError("invalid size: '%s'" % text)
+    return int(m.group(1)) * 1024 ** ' kmgt'.index(m.group(2).lower() or ' ')
+
+
+class ClientSocket():
+    """
+    A connection to the socket API of one owncloud client instance.
+
+    All sync folders served by the same client share one connection.
+    The connection is opened on first use and reopened after errors.
+    """
+
+    def __init__(self, sock_file):
+        self.sock_file = sock_file
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def _drain(self):
+        """ collect what the client says, until it is quiet for a moment. """
+        seen = b''
+        try:
+            while True:
+                buf = self.sock.recv(1024)
+                if not buf:
+                    break
+                seen += buf
+        except socket.timeout:
+            pass
+        return seen
+
+    def command(self, cmd):
+        """ send one line to the client. Returns the list of lines received in reply,
+            or [] if the command could not be delivered.
+        """
+        with self.lock:
+            for attempt in (1, 2):
+                try:
+                    if self.sock is None:
+                        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                        self.sock.settimeout(0.2)
+                        self.sock.connect(self.sock_file)
+                        self._drain()   # discard the greeting, if any.
+                    self.sock.send((cmd+"\n").encode('utf-8'))
+                    seen = self._drain()
+                    return seen[:seen.rfind(b'\n')].decode('utf-8').split('\n')
+                except Exception as e:
+                    print("+ ClientSocket(%s): attempt %d failed: %s" % (self.sock_file, attempt, str(e)), file=sys.stderr)
+                    self.close()
+            return []       # a delivered command always yields at least [''].
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+        self.sock = None
+
+
+class HydrationBudget():
+    """
+    Limits the number of bytes that may be in flight for download
+    from virtual to physical, summed over all sync folders of the daemon.
+
+    limit=0 means unlimited. A single file larger than the limit is
+    admitted when nothing else is in flight, so that it cannot starve.
+
+    This is not a cache limit: finished downloads stay physical and are
+    no longer counted here.
+    """
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.used = 0
+        self.stopped = False
+        self.cond = threading.Condition()
+
+    def acquire(self, size):
+        """ returns True when size is accounted, False if stop() came first. """
+        with self.cond:
+            while self.limit and self.used and self.used + size > self.limit and not self.stopped:
+                self.cond.wait()
+            if self.stopped:
+                return False
+            self.used += size
+            return True
+
+    def release(self, size):
+        with self.cond:
+            self.used -= size
+            self.cond.notify_all()
+
+    def stop(self):
+        """ wake up all waiters in acquire(), and let them fail. """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+
+class OCFFSShared():
+    """
+    Resources shared by all sync folders of one OCFFS process:
+    the worker pool, the client socket connections (one per client instance)
+    and the global hydration budget.
+
+    hydration_timeout is how long (in seconds) a worker waits for one
+    download to finish, before it gives up and takes the next one.
+    """
+
+    def __init__(self, workers=4, hydration_budget=0, hydration_timeout=600):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.budget = HydrationBudget(hydration_budget)
+        self.hydration_timeout = hydration_timeout
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.stop = threading.Event()   # set by close(), ends all waiting in the pool.
+
+    def client(self, uid, shortname):
+        """ returns the ClientSocket for the client instance, creating it on first use. """
+        sock_file = '/run/user/'+str(uid)+'/'+shortname+'/socket'
+        with self.lock:
+            if sock_file not in self.clients:
+                self.clients[sock_file] = ClientSocket(sock_file)
+            return self.clients[sock_file]
+
+    def close(self):
+        self.stop.set()
+        self.budget.stop()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        with self.lock:
+            for c in self.clients.values():
+                c.close()
+
 
 class OCFFS(Operations):
     """
@@ -37,20 +233,35 @@ class OCFFS(Operations):
     files.
     """
 
-    def __init__(self, root, mountpoint=None):
+    def __init__(self, root, mountpoint=None, shared=None, pids=None):
+        """
+        shared: an OCFFSShared instance, when several sync folders are served
+                by one process. A private one is created otherwise.
+        pids:   the result of find_owncloud_threads() for our dbfile, if the
+                caller already scanned. We scan ourselves otherwise.
+        """
         self.root = root
         self.mountpoint = mountpoint
         self.vfd = {}           # virtual file descriptor table.
         self.blocksize = 4096   # our read will return blocks of this size.
+        self.shared = shared
+        self.own_shared = shared is None
+        if self.own_shared:
+            self.shared = OCFFSShared()
+        self.stats = { 'ops': 0, 'op': {}, 'bytes_read': 0, 'bytes_written': 0,
+                       'hydrations_queued': 0, 'hydrations_done': 0, 'hydrations_failed': 0,
+                       'last_op': None }
+        self.stats_lock = threading.Lock()
+        self.hydrating = set()          # vpaths with a _hydrate job queued or running.
+        self.hydrating_lock = threading.Lock()
         # find the owncloud db file:
-        self.dbfile = None
-        for dbfile in os.listdir(root):
-            if re.match('\._sync_[a-f0-9]+\.db$', dbfile): self.dbfile = root + '/' + dbfile
+        self.dbfile = find_dbfile(root)
         if self.dbfile is None:
             print("No database file '._sync_*.db' found in "+root, file=sys.stderr)
             sys.exit(1)
 
-        pids = self._find_owncloud_threads()
+        if pids is None:
+            pids = self._find_owncloud_threads()
         if len(pids) < 1:
             print("dbfile '"+self.dbfile+"' has no owncloud client process.", file=sys.stderr)
             print("Please start the client or remove the orphant dbfile", file=sys.stderr)
@@ -68,7 +279,9 @@ class OCFFS(Operations):
         if len(pids) > 1:
             print("Extra processes on dbfile ignored: "+str(pids), file=sys.stderr)
         if self.dbfile:
-            self.db = sqlite3.connect(self.dbfile)
+            # each sync folder keeps its own metadata index.
+            # opened here, but used from the FUSE thread of this mountpoint.
+            self.db = sqlite3.connect(self.dbfile, check_same_thread=False)
 
     def __enter__(self):
         print("OCFFS v%s starting ..." % (_version_), file=sys.stderr)
@@ -78,6 +291,34 @@ class OCFFS(Operations):
         print("\nOCFFS exiting...", file=sys.stderr)
         if self.db:
             self.db.close()
+        if self.own_shared:
+            self.shared.close()
+
+    def __call__(self, op, *args):
+        """ all filesystem calls come through here. Count them per mountpoint.
+            Reading user.owncloud.stats is not counted, the value must not change
+            between the size query and the fetch that fusepy does for one getxattr.
+        """
+        if not (op == 'getxattr' and args[:2] == ("/", "user.owncloud.stats")):
+            with self.stats_lock:
+                self.stats['ops'] += 1
+                self.stats['op'][op] = self.stats['op'].get(op, 0) + 1
+                self.stats['last_op'] = int(time.time())
+        return Operations.__call__(self, op, *args)
+
+    def _count(self, key, n=1):
+        with self.stats_lock:
+            self.stats[key] += n
+
+    def get_stats(self):
+        """ returns a copy of the per-mountpoint statistics. """
+        with self.stats_lock:
+            ret = dict(self.stats)
+            ret['op'] = dict(self.stats['op'])
+        ret['root'] = self.root
+        ret['mountpoint'] = self.mountpoint
+        ret['open_files'] = len(self.vfd)
+        return ret
 
 
     # Helpers
@@ -114,35 +355,10 @@ class OCFFS(Operations):
 
 
     def _find_owncloud_threads(self):
-        """ enumerate processes, filter those with same euid as the dbfile.
-            then find one that also has the dbfile open.
-            We asume, we run as the user who owns the dbfile.
-            (If not Process.open_file() may fail.)
-
-            Returns a list of triples: [ (pid, name, uid), ... ]
+        """ Returns a list of triples: [ (pid, name, uid), ... ]
+            of the owncloud client processes that have our dbfile open.
         """
-        db_path = os.path.realpath(self.dbfile)
-        db_uid = os.stat(db_path).st_uid
-        pids = []
-        for p in psutil.process_iter(attrs=['name']):
-            euid = p.uids().effective
-            uid = p.uids().real
-            if db_uid == euid or db_uid == uid:
-                # print("+ pid=%s (%s) match db_uid=%s euid=%s uid=%s" % (p.pid, p.name(), db_uid,euid,uid), file=sys.stderr)
-                try:
-                    for f in p.open_files():
-                        if f.path == db_path:
-                            if p.pid == os.getpid():
-                                print("+ FIXME: saw myself on the database. Harmless, but should not happen.", file=sys.stderr)
-                                pass
-                            else:
-                                # print("+ seen: owncloud client pid=%s name=%s" % (p.pid, p.name()), file=sys.stderr)
-                                pids.append([p.pid, p.name(), db_uid])
-                except:
-                    # open_files may fire PermissionError or psutil._exceptions.AccessDenied
-                    # on e.g. "gpg-agent", which does not like to be examined.
-                    pass
-        return pids
+        return find_owncloud_threads([self.dbfile])[self.dbfile]
 
 
     def _oc_stat(self, path):
@@ -209,20 +425,59 @@ class OCFFS(Operations):
         if not rpath.endswith(self.virtual_suffix):
             print("+ _convert_v2p: is already physical: path="+rpath, file=sys.stderr)
             return 0
-        sock_file = '/run/user/'+str(self.client_uid)+'/'+self.client_executable_shortname+'/socket'
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        cmd = "DOWNLOAD_VIRTUAL_FILE:"+os.path.realpath(rpath)+"\n"
+        with self.hydrating_lock:
+            if rpath in self.hydrating:
+                print("+ _convert_v2p: already being downloaded: path="+rpath, file=sys.stderr)
+                return 0
+            self.hydrating.add(rpath)
+        size = max(int(self._oc_stat(rpath)[2]), 0)   # from the FUSE thread, sqlite stays out of the pool.
+        self._count('hydrations_queued')
+        self.shared.pool.submit(self._hydrate, rpath, size)
+        return 1
+
+
+    def _hydrate(self, vpath, size):
+        """ worker pool job: ask the client to download vpath, and wait until it is physical.
+
+            The download is accounted against the global hydration budget
+            from the request until the placeholder is gone.
+        """
+        budget = self.shared.budget
+        if not budget.acquire(size):
+            self._hydrated(vpath)
+            return 0    # shutting down.
         try:
-            sock.connect(sock_file)
-            sock.send(cmd.encode('utf-8'))
+            client = self.shared.client(self.client_uid, self.client_executable_shortname)
+            seen = client.command("DOWNLOAD_VIRTUAL_FILE:"+os.path.realpath(vpath))
+            if seen == []:      # command() could not deliver, nothing to wait for.
+                print("+ _hydrate: request not delivered for "+vpath, file=sys.stderr)
+                self._count('hydrations_failed')
+                return 0
+            print("+ _hydrate: received: " + str(seen), file=sys.stderr)
+            deadline = time.time() + self.shared.hydration_timeout
+            while os.path.exists(vpath):
+                if time.time() > deadline:
+                    print("+ _hydrate: timeout waiting for "+vpath, file=sys.stderr)
+                    self._count('hydrations_failed')
+                    return 0
+                if self.shared.stop.wait(0.5):
+                    print("+ _hydrate: shutdown while waiting for "+vpath, file=sys.stderr)
+                    self._count('hydrations_failed')
+                    return 0
+            self._count('hydrations_done')
+            return 1
         except Exception as e:
-            print("+ _convert_v2p: send failed: " + str(e), file=sys.stderr)
-        sock.settimeout(0.2)
-        seen = sock.recv(1024)
-        seen = seen[:seen.rfind(b'\n')].decode('utf-8').split('\n')
-        print("+ _convert_v2p: received: " + str(seen), file=sys.stderr)
-        sock.close()
-        return 1
+            print("+ _hydrate: failed: " + str(e), file=sys.stderr)
+            self._count('hydrations_failed')
+            return 0
+        finally:
+            budget.release(size)
+            self._hydrated(vpath)
+
+    def _hydrated(self, vpath):
+        """ vpath may be requested again. """
+        with self.hydrating_lock:
+            self.hydrating.discard(vpath)
 
 
     # Filesystem methods
@@ -362,12 +617,14 @@ class OCFFS(Operations):
         """
         print("+ read(%s, %s, %s, %s)" % (path, length, offset, fh), file=sys.stderr)
         if fh in self.vfd:
+            buf = b''
             if offset < 100:
-                return b"go get some coffee\n"
-            return b''
+                buf = b"go get some coffee\n"
         else:
             os.lseek(fh, offset, os.SEEK_SET)
-            return os.read(fh, length)
+            buf = os.read(fh, length)
+        self._count('bytes_read', len(buf))
+        return buf
 
     def write(self, path, buf, offset, fh):
         print("+ write(%s, '%s', %s, %s, %s)" % (path, buf, offset, fh), file=sys.stderr)
@@ -375,7 +632,9 @@ class OCFFS(Operations):
             raise FuseOSError(errno.EREMOTE)    # virtual files just cannot be written for now.
         else:
             os.lseek(fh, offset, os.SEEK_SET)
-            return os.write(fh, buf)
+            n = os.write(fh, buf)
+            self._count('bytes_written', n)
+            return n
 
     def truncate(self, path, length, fh=None):
         rpath = self._oc_path(path)[0]
@@ -408,17 +667,29 @@ class OCFFS(Operations):
     #   Subdirectories don't.
     # * the value remains on a directory until the first file gets this value set differently.
     #   then the attribute is removed from the directory.
+    #
+    # And a read-only key on the top directory of the mountpoint: 'user.owncloud.stats'
+    # * the value is a json dict with the statistics of this mountpoint.
+    #   padded with blanks to a multiple of 4096 bytes.
+    #   getfattr --only-values -n user.owncloud.stats MOUNTPOINT
 
     def listxattr(self, path):
         rpath = self._oc_path(path)[0]
         xa = os.listxattr(path=rpath, follow_symlinks=True)
         if os.path.isfile(rpath) and "user.owncloud.virtual" not in xa:
             xa.append("user.owncloud.virtual")
+        if path == "/" and "user.owncloud.stats" not in xa:
+            xa.append("user.owncloud.stats")
         return xa
 
     def getxattr(self, path, name, position=0):
         rpath,virt = self._oc_path(path)
         print("+ getxattr(%s, %s, %s)" % (rpath, name, position), file=sys.stderr)
+        if path == "/" and name == "user.owncloud.stats":
+            # hydration workers may count between the size query and the fetch.
+            # Padded with blanks to a multiple of 4k, the size stays the same.
+            value = json.dumps(self.get_stats(), sort_keys=True).encode('utf-8')
+            return value.ljust(-(-len(value) // 4096) * 4096)
         if os.path.isfile(rpath):
             if name == "user.owncloud.virtual":
                 if virt:
@@ -429,6 +700,8 @@ class OCFFS(Operations):
 
     def setxattr(self, path, name, value, options, position=0):
         rpath,virt = self._oc_path(path)
+        if path == "/" and name == "user.owncloud.stats":
+            raise FuseOSError(errno.EPERM)  # read-only.
         if name == "user.owncloud.virtual" and not self._be_transparent():
             if value == b'0' or value == b'':
                 if virt:
@@ -443,22 +716,178 @@ class OCFFS(Operations):
             return 0
         return os.setxattr(rpath, name, value, flags=options)
 
+    def removexattr(self, path, name):
+        if path == "/" and name == "user.owncloud.stats":
+            raise FuseOSError(errno.EPERM)  # read-only.
+        return Operations.removexattr(self, path, name)
+
 
 ## need user_allow_other in /etc/fuse.conf
+def mount(ocffs, mountpoint):
+    try:
+        FUSE(ocffs, mountpoint, nothreads=True, foreground=True, debug=True, allow_other=True)
+    except RuntimeError:
+        print(" -- mountpoint %s is only usable for current user." % mountpoint, file=sys.stderr)
+        FUSE(ocffs, mountpoint, nothreads=True, foreground=True, debug=True, allow_other=False)
+
+
+def print_stats(mounts):
+    for ocffs in mounts:
+        print("+ stats: " + json.dumps(ocffs.get_stats(), sort_keys=True), file=sys.stderr)
+
+
 def main(root, mountpoint=None):
     if mountpoint is None:
         mountpoint = root + ".ocffs"
 
     with OCFFS(root, mountpoint) as ocffs:
+        # same as in daemon(). The default action of SIGUSR1 would kill us without unmounting.
+        # The stats are printed with the next filesystem call, when python runs again.
+        signal.signal(signal.SIGUSR1, lambda signum, frame: print_stats([ocffs]))
+        mount(ocffs, mountpoint)
+
+
+def daemon(config_file):
+    """
+    Serve all sync folders listed in config_file from one process.
+    Each sync folder is a section with a root and an optional mountpoint.
+    The [General] section holds the settings shared by all of them:
+
+        [General]
+        workers = 4
+        hydration_budget = 2G
+
+        [Photos]
+        root = /home/testy/ownCloud/Photos
+        mountpoint = /home/testy/Photos
+
+    Each mountpoint runs its own FUSE loop in a thread. kill -USR1 prints
+    the per-mountpoint statistics, Ctrl-C or kill unmounts all.
+    """
+    config = configparser.ConfigParser()
+    try:
+        if not config.read(config_file):
+            print("Cannot read config file "+config_file, file=sys.stderr)
+            sys.exit(1)
+    except configparser.Error as e:
+        print("Cannot parse config file %s: %s" % (config_file, str(e)), file=sys.stderr)
+        sys.exit(1)
+    general = config['General'] if config.has_section('General') else {}
+    settings = {}
+    for (key, default, conv) in (('workers', '4', int),
+                                 ('hydration_budget', '0', parse_size),
+                                 ('hydration_timeout', '600', int)):
+        try:
+            settings[key] = conv(general.get(key, default))
+            if key == 'workers' and settings[key] < 1:
+                raise ValueError(key)
+        except ValueError:
+            print("[General] %s = %s in %s is not valid." % (key, general.get(key), config_file), file=sys.stderr)
+            sys.exit(1)
+
+    folders = []
+    seen_roots = {}
+    seen_mountpoints = {}
+    for name in config.sections():
+        if name == 'General': continue
+        root = config[name].get('root')
+        if root is None:
+            print("Section [%s] in %s has no root." % (name, config_file), file=sys.stderr)
+            sys.exit(1)
+        mountpoint = config[name].get('mountpoint', root + ".ocffs")
+        if not os.path.isdir(root):
+            print("Section [%s]: root %s is not a directory." % (name, root), file=sys.stderr)
+            sys.exit(1)
+        if not os.path.isdir(mountpoint):
+            print("Section [%s]: mountpoint %s is not a directory." % (name, mountpoint), file=sys.stderr)
+            sys.exit(1)
+        for (path, what, seen) in ((root, 'root', seen_roots), (mountpoint, 'mountpoint', seen_mountpoints)):
+            real = os.path.realpath(path)
+            if real in seen:
+                print("Section [%s]: %s %s is already used in [%s]." % (name, what, path, seen[real]), file=sys.stderr)
+                sys.exit(1)
+            seen[real] = name
+        dbfile = find_dbfile(root)
+        if dbfile is None:
+            print("No database file '._sync_*.db' found in "+root, file=sys.stderr)
+            sys.exit(1)
+        folders.append((root, mountpoint, dbfile))
+    if not folders:
+        print("No sync folders in config file "+config_file, file=sys.stderr)
+        sys.exit(1)
+
+    shared = OCFFSShared(**settings)
+    pids = find_owncloud_threads([dbfile for (root, mountpoint, dbfile) in folders])
+    mounts = []
+    try:
+        # all folders are checked before the first one is mounted.
+        # OCFFS() does sys.exit() when a folder has no client.
+        for (root, mountpoint, dbfile) in folders:
+            mounts.append(OCFFS(root, mountpoint, shared=shared, pids=pids[dbfile]).__enter__())
+    except SystemExit:
+        for ocffs in mounts:
+            ocffs.__exit__(None, None, None)
+        shared.close()
+        raise
+
+    # libfuse 2 keeps only one session for its SIGTERM/SIGHUP handler, so
+    # kill would end just the last mountpoint. It only takes over signals that
+    # are still at SIG_DFL, thus ours is installed before the first fuse_main().
+    def terminate(signum, frame):
+        print("\n+ signal %d: unmounting all" % signum, file=sys.stderr)
+        sys.exit(0)     # unwinds through the finally below.
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGHUP, terminate)
+
+    failed = []
+    def serve(ocffs):
         try:
-            FUSE(ocffs, mountpoint, nothreads=True, foreground=True, debug=True, allow_other=True)
-        except RuntimeError:
-            print(" -- mountpoint %s is only usable for current user." % mountpoint, file=sys.stderr)
-            FUSE(ocffs, mountpoint, nothreads=True, foreground=True, debug=True, allow_other=False)
+            mount(ocffs, ocffs.mountpoint)
+        except Exception as e:
+            print("Cannot mount %s: %s" % (ocffs.mountpoint, str(e)), file=sys.stderr)
+            failed.append(ocffs.mountpoint)
+
+    threads = []
+    try:
+        for ocffs in mounts:
+            t = threading.Thread(target=serve, args=(ocffs,), name=ocffs.mountpoint)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        signal.signal(signal.SIGUSR1, lambda signum, frame: print_stats(mounts))
+        while any(t.is_alive() for t in threads):
+            time.sleep(0.5)     # not join(): an exception from a signal handler
+                                # inside join() can leave is_alive() wrong.
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # a supervisor may send another SIGTERM. It must not cut the cleanup short.
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        # whatever ended us, no FUSE loop may keep serving with a closed db.
+        for (t, ocffs) in zip(threads, mounts):
+            if t.is_alive():
+                try:
+                    subprocess.call(["fusermount", "-u", ocffs.mountpoint])
+                except OSError as e:
+                    print("+ fusermount -u %s failed: %s" % (ocffs.mountpoint, str(e)), file=sys.stderr)
+        for t in threads:
+            t.join(5)
+        print_stats(mounts)
+        for ocffs in mounts:
+            ocffs.__exit__(None, None, None)
+        shared.close()
+    if failed:
+        sys.exit(1)
+
 
 if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] in ('-c', '--config'):
+        daemon(sys.argv[2])
+        sys.exit(0)
     if len(sys.argv) < 3:
       print("Usage: %s OC_SHAREFOLDER NEW_MOUNTPOINT" % (sys.argv[0]))
+      print("       %s -c CONFIG_FILE" % (sys.argv[0]))
       sys.exit(1)
     main(sys.argv[1], sys.argv[2])
-